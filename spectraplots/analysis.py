@@ -1,15 +1,22 @@
 """Spectra Methods"""
 import os
-import sys
 
-import h5py
 import numpy as np
-from scipy.optimize import least_squares
+from scipy.optimize import least_squares, OptimizeResult
 from scipy.constants import h, c, e
 import peakutils
+try:
+    import numba
+except ImportError:
+    numba = None
 
 from .h5utils import h5Utils, criteria_name, is_dataset, is_group, _default_func
 
+#Parser options shared by every ASCII read (numpy>=1.23 uses its C reader)
+_LOADTXT_KWARGS = {'dtype': np.float64, 'ndmin': 2}
+#h*c/e in eV*nm, used by nm_to_ev
+_NM_EV_CONST = h * c / (e * 1e-9)
+
 
 def find_near(a, Near):
     """
@@ -21,10 +28,25 @@ def find_near(a, Near):
         The "x" array position with the nearest value to "Near" value
     """
     a = np.asarray(a)
+    #spectra axes are usually sorted: binary search instead of a full scan
+    if _is_sorted(a): return _find_near_sorted(a, Near)
     nearpos = (np.abs(a-Near)).argmin()
     return nearpos
 
 
+def _is_sorted(a):
+    return a.ndim == 1 and a.size >= 2 and bool(np.all(a[:-1] <= a[1:]))
+
+
+def _find_near_sorted(a, Near):
+    """find_near for a 1-D non-decreasing array"""
+    i = int(np.searchsorted(a, Near))
+    if i == a.size or (i > 0 and abs(a[i]-Near) >= abs(a[i-1]-Near)):
+        i -= 1
+    #first occurrence of repeated values, like argmin
+    return int(np.searchsorted(a, a[i]))
+
+
 def array_region(a, *intervals, index=False, dim=0):
     """
     Returns the selected region selected with the *intervals pos variable
@@ -47,35 +69,45 @@ def array_region(a, *intervals, index=False, dim=0):
         The concatenated array with intervasl chosen.
 
     """
-    def __region(a, begin, end):
-        if begin<=end: 
-            return a[begin:end]
-        else:
-            return a[end:begin]
-
     a = np.asarray(a)
-    if intervals:
-        for i, interval in enumerate(intervals):
-            if index: begin, end = a[interval[0], interval[1]]
-            else : begin, end= (find_near(a[:, dim], interval[0]),
-                                find_near(a[:, dim], interval[1])
-                                )
-            if i==0: region = __region(a, begin, end)
-            else: region = np.concatenate((region,__region(a, begin, end)))
-    else: region=a
-    return region
+    if not intervals: return a
+    return _gather(a, _interval_slices(a, intervals, index, dim))
+
+
+def _interval_slices(a, intervals, index=False, dim=0):
+    """Row slices of array_region, reusable on arrays sharing the axis"""
+    #the axis is extracted and checked for order once, not per endpoint
+    if not index:
+        axis = a[:, dim]
+        near = _find_near_sorted if _is_sorted(axis) else find_near
+    slices = []
+    for interval in intervals:
+        if index: begin, end = interval[0], interval[1]
+        else : begin, end= (near(axis, interval[0]),
+                            near(axis, interval[1])
+                            )
+        if begin<=end: slices.append(slice(begin, end))
+        else: slices.append(slice(end, begin))
+    return slices
+
+
+def _gather(a, slices):
+    #a single interval is returned as a view, several are copied once into
+    #one buffer sized from the slices
+    if len(slices) == 1: return a[slices[0]]
+    return np.concatenate([a[s] for s in slices], axis=0)
 
 
 def nm_to_ev(unit):
-    np.seterr(divide='ignore', invalid='ignore')  # Suppress divide-by-zero warnings
-    try:
-        to_unit = h * c / (unit * e * 1e-9)
-    except ZeroDivisionError as err:
-        print('nanometers or eV cant be zero:', err)
-        return np.nan
-    finally:
-        np.seterr(divide='warn', invalid='warn')  # Reset warning behavior
-    return np.where(unit != 0, to_unit, np.nan)
+    """
+    nm_to_ev(unit)
+    Convert nanometers to eV (or eV to nanometers), zero values give NaN
+    """
+    unit = np.asarray(unit, dtype=np.float64)
+    out = np.full_like(unit, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(_NM_EV_CONST, unit, out=out, where=unit!=0)
+    return out
 
 
 def folder_average(path, folder_name='', fmt='%1.5f', display=False):
@@ -119,12 +151,18 @@ def folder_average(path, folder_name='', fmt='%1.5f', display=False):
         if display: print('No files')
         return None
 
+    #stack every folder version of the file and reduce once, the buffers
+    #are reused while the files keep the same shape
+    buf = None
     for file in path_files:
         for count,  folder  in enumerate(path_folders):
-            data = np.loadtxt(path+folder+file) 
-            if count ==0: average = np.zeros_like(data)
-            average = data + average 
-        np.savetxt(path+file, average/(count+1), fmt=fmt)
+            data = np.loadtxt(path+folder+file, **_LOADTXT_KWARGS)
+            if count == 0 and (buf is None or buf.shape[1:] != data.shape):
+                buf = np.empty((len(path_folders),) + data.shape)
+                average = np.empty(data.shape)
+            buf[count] = data
+        np.mean(buf, axis=0, out=average)
+        np.savetxt(path+file, average, fmt=fmt)
         if display: print(f'Successful file:{path+file}')
 
 
@@ -163,21 +201,27 @@ def baseline(dataset, interval=[], name= '', suffix='',prefix='',
     if prefix: name = f'{prefix}name'
     if suffix: name = f'name{suffix}'
     if is_dataset(dataset):
-        data = np.array(dataset)
-        if interval: data = array_region(data, interval)
+        if interval:
+            #only the rows inside the interval are read from the file
+            xcol = dataset[:,0]
+            begin, end = sorted((find_near(xcol, interval[0]),
+                                 find_near(xcol, interval[1])))
+            data = np.asarray(dataset[begin:end], dtype=float)
+        else: data = np.asarray(dataset[()], dtype=float)
         _baseline =  peakutils.baseline(data[:,1], 
                                         deg=deg, max_it=max_it, tol=tol)
-        data[:,1] = data[:,1]-_baseline
-        base  = data.copy()
-        base[:,1] = _baseline
-        dataset.attrs.create(f'{name}', data=np.array(base))
+        data[:,1] -= _baseline
+        #only the energy column is shared with the data
+        base = np.column_stack((data[:,0], _baseline))
+        dataset.attrs.create(f'{name}', data=base)
         dataset.attrs.create(f'{name}.Interval', data = np.array(interval))
-        dataset.attrs.create(f'{name}.Substract', data = np.array(data))
+        dataset.attrs.create(f'{name}.Substract', data = data)
 
 
 def mk_map(file_name_or_object, name='Map', mode='r+',
            name_criteria=None, object_criteria=None, func=None,
-           xattr = 'OssilaX2000.SMU1 Voltage(V)', baseline='', attributes=[]): 
+           xattr = 'OssilaX2000.SMU1 Voltage(V)', baseline='', attributes=[],
+           **kwargs): 
     """
     Create a photoluminescence map (X, Y, Z).
 
@@ -209,7 +253,11 @@ def mk_map(file_name_or_object, name='Map', mode='r+',
 
    attributes : list, optional, default: []
         A list of numeric attribute names to be aggregated and stored in the output dataset. The function computes the average of these attributes across all datasets.
-        
+
+    **kwargs : additional keyword arguments
+        Passed to h5py.File when a file name is given, e.g. rdcc_nbytes and
+        rdcc_nslots for the raw-data chunk cache. For large maps raise
+        rdcc_nbytes to about half the total size of the datasets read.
 
     Returns
     -------
@@ -221,53 +269,65 @@ def mk_map(file_name_or_object, name='Map', mode='r+',
     """
     sample = h5Utils(file_name_or_object,mode=mode,
                      name_criteria=name_criteria, object_criteria=object_criteria,
-                     func=func)
-    keys = sample.mk_keys()
-    sample.func = _default_func
-    x = np.zeros(len(keys))
-
-    for count, dataset in enumerate(sample.apply_keys(keys)):
-        #suppose that all data is similar in size
-        if baseline: array = np.array(dataset.attrs.get(baseline))
-        else: array = np.array(dataset)
-
-        if count == 0:
-            x[count] = dataset.attrs.get(xattr)
-            attributes_dict = {}
-            for attribute in attributes:
-                    attributes_dict[attribute] = np.float64(dataset.attrs.get(attribute))
-               
-            y = array[:,0]
-            X, Y  = np.meshgrid(x, y)
-            Z = np.zeros_like(X)
-            Z[:,count] = array[:,1]
-
-        else:
-
-            for attribute in attributes:
-                attributes_dict[attribute] += np.float64(dataset.attrs.get(attribute))
-
-            x[count] = dataset.attrs.get(xattr)
-            X[:,count] = x[count]
-            Z[:,count] = array[:,1]
-        if count==len(keys)-1:
-            try:
-                root = dataset
-                while True:
-                    root = root.parent
-                    if root.name == '/':
-                        break
-                mesh = root.create_dataset(name, data=np.array([X, Y, Z]))
-                for attribute in attributes:
-                    mesh.attrs.create(attribute, attributes_dict[attribute]/(count+1))
-            except ValueError:
-                print(ValueError, 'try another name')
+                     func=func, **kwargs)
+    with sample:
+        keys = sample.mk_keys()
+        sample.func = _default_func
+        nkeys = len(keys)
+        x = np.empty(nkeys)
+        attr_arr = np.empty((nkeys, len(attributes)))
+        count = -1
+        mesh = None
+
+        #a failure half way leaves no partially written map behind
+        try:
+            for count, dataset in enumerate(sample.apply_keys(keys)):
+                #suppose that all data is similar in size
+                #read only the columns needed straight from the h5py dataset
+                if baseline: array = np.asarray(dataset.attrs.get(baseline))
+                else: array = dataset
+
+                if count == 0:
+                    #intensities are streamed column by column into a chunked,
+                    #compressed dataset (chunks <= 1 MiB) instead of stacking X, Y, Z
+                    y = array[:,0]
+                    nrows = y.shape[0]
+                    if nrows == 0:
+                        raise ValueError(f'{dataset.name} has no rows to map')
+                    ncols = max(1, min(nkeys, (1 << 20)//(3*nrows*8)))
+                    try:
+                        mesh = dataset.file.create_dataset(name, shape=(3, nrows, nkeys),
+                                maxshape=(3, nrows, nkeys), dtype='f8',
+                                chunks=(3, nrows, ncols),
+                                compression='lzf', shuffle=True)
+                    except ValueError:
+                        print(ValueError, 'try another name')
+                        return None
+
+                x[count] = dataset.attrs.get(xattr)
+                mesh[2, :, count] = array[:,1]
+                for j, attribute in enumerate(attributes):
+                    attr_arr[count, j] = dataset.attrs.get(attribute, np.nan)
+
+            #missing keys are skipped by apply_keys: keep only the columns read
+            nread = count + 1
+            if nread == 0: return None
+            if nread < nkeys: mesh.resize(nread, axis=2)
+            #X and Y only depend on x and y: one meshgrid of views at the end
+            X, Y = np.meshgrid(x[:nread], y, copy=False)
+            mesh[0] = X
+            mesh[1] = Y
+            for j, attribute in enumerate(attributes):
+                mesh.attrs.create(attribute, attr_arr[:nread, j].mean())
+        except BaseException:
+            if mesh is not None: del mesh.file[mesh.name]
+            raise
     return None
 
 
 def mk_profile(file_name_or_object, keys, profile_value, name='Profile',
         xattr = 'Wavelenght(nm)', baseline='', attributes=[], 
-        mode='r+', func=None):
+        mode='r+', func=None, shared_axis=False, **kwargs):
     """
     Create a profile dataset based on specified values in HDF5 datasets. 
     Used for PLE
@@ -300,37 +360,53 @@ def mk_profile(file_name_or_object, keys, profile_value, name='Profile',
     func : callable, optional
         A function to process the profile values before storing them in the dataset. This function should accept the profile value and the dataset as parameters and return the processed value.
 
+    shared_axis : bool, optional, default: False
+        If all the spectra share the same energy axis, the profile point is
+        searched only in the first dataset and reused for the rest.
+
+    **kwargs : additional keyword arguments
+        Passed to h5py.File when a file name is given, e.g. rdcc_nbytes and
+        rdcc_nslots for the raw-data chunk cache. For large maps raise
+        rdcc_nbytes to about half the total size of the datasets read.
+
     Returns
     -------
     None
 
     """
 
-    sample = h5Utils(file_name_or_object,mode=mode)
+    sample = h5Utils(file_name_or_object,mode=mode, **kwargs)
     x = np.zeros(len(keys))
     y = np.zeros(len(keys))
-
-    for count, dataset in enumerate(sample.apply_keys(keys)):
-        x[count] = float(dataset.attrs.get(xattr))
-        point = find_near(dataset[:,0], profile_value)
-
-        if baseline: y[count] = dataset.attrs.get(baseline)[point, 1]
-        else: y[count] = dataset[point, 1]
-        if func: y[count] = func(y[count], dataset) 
-
-        if count==len(keys)-1:
-            try:
-                root = dataset
-                while True:
-                    root = root.parent
-                    if root.name == '/':
-                        break
-                profile = np.stack((x,y), axis=-1)
-                dataset_profile = root.create_dataset(name, data=profile)
-                for attribute in attributes:
-                    dataset_profile.attrs.create(attribute, attributes_dict[attribute]/(count+1))
-            except ValueError:
-                print(ValueError, 'try another name')
+    attributes_dict = {attribute: 0.0 for attribute in attributes}
+    func = func or (lambda value, dataset: value)
+    point = None
+
+    with sample:
+        count = -1
+        for count, dataset in enumerate(sample.apply_keys(keys)):
+            x[count] = float(dataset.attrs.get(xattr))
+            for attribute in attributes:
+                attributes_dict[attribute] += dataset.attrs.get(attribute, np.nan)
+
+            #the attribute is rebuilt by h5py on every access: read it once
+            if baseline: array = np.asarray(dataset.attrs.get(baseline))
+            else: array = dataset
+            if point is None or not shared_axis:
+                point = find_near(array[:,0], profile_value)
+            y[count] = func(array[point, 1], dataset)
+
+        #missing keys are skipped by apply_keys: keep only the rows read
+        nread = count + 1
+        if nread == 0: return None
+        try:
+            root = dataset.file
+            profile = np.stack((x[:nread], y[:nread]), axis=-1)
+            dataset_profile = root.create_dataset(name, data=profile)
+            for attribute in attributes:
+                dataset_profile.attrs.create(attribute, attributes_dict[attribute]/nread)
+        except ValueError:
+            print(ValueError, 'try another name')
 
     return None
 
@@ -347,16 +423,85 @@ def linear_model(x, m=1.0, b=0.0):
     """
     return x*m + b
 
+#numpy's own exp is SIMD vectorised: the compiled loop only pays off
+#when it can spread over several threads
+_SOMMERFEL_JIT = numba is not None and numba.config.NUMBA_NUM_THREADS > 1
+
+if _SOMMERFEL_JIT:
+    #numpy error model: x == center gives inf in the root as with numpy,
+    #fastmath without the no-nan/no-inf assumptions for the same reason
+    @numba.njit(parallel=True, cache=True, error_model='numpy',
+            fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})
+    def _sommerfel_core(x, amplitude, center, sigma, rydberg, out):
+        for i in numba.prange(x.size):
+            d = x[i] - center
+            out[i] = (amplitude/(1 + np.exp(-d/sigma))
+                    * 2/(1 + np.exp(-2*np.pi*np.sqrt(rydberg/abs(d)))))
+
+
 def sommerfel_broadening(x, amplitude, center, sigma, rydberg):
-    return ((amplitude/(1+np.exp((-x+center)/sigma)))
-            *(2/(1+np.exp(-2*np.pi*np.sqrt(rydberg/abs(x-center))))))
+    """Sommerfeld broadened band edge
+    amplitude/(1+exp((center-x)/sigma)) * 2/(1+exp(-2pi*sqrt(rydberg/|x-center|)))
+    With numba installed, more than one thread and scalar parameters it
+    runs as one parallel compiled loop, otherwise it is evaluated in place
+    on two work arrays, without per-operation temporaries.
+    """
+    if _SOMMERFEL_JIT and all(np.ndim(parameter) == 0 for parameter
+            in (amplitude, center, sigma, rydberg)):
+        x = np.asarray(x, dtype=np.float64, order='C')
+        out = np.empty(x.shape)
+        _sommerfel_core(x.reshape(-1), float(amplitude), float(center),
+                float(sigma), float(rydberg), out.reshape(-1))
+        return out
+    #array parameters (e.g. from lmfit) may broadcast x to a larger shape
+    d = np.empty(np.broadcast_shapes(np.shape(x), np.shape(amplitude),
+            np.shape(center), np.shape(sigma), np.shape(rydberg)))
+    d[...] = x
+    d -= center
+    t = np.empty_like(d)
+    #Sommerfeld factor
+    np.abs(d, out=t)
+    np.divide(rydberg, t, out=t)
+    np.sqrt(t, out=t)
+    t *= -2*np.pi
+    np.exp(t, out=t)
+    t += 1
+    np.divide(2, t, out=t)
+    #step
+    d /= -sigma
+    np.exp(d, out=d)
+    d += 1
+    np.divide(amplitude, d, out=d)
+    d *= t
+    return d
 
 
 ###############################################################################
 #Fits
 ###############################################################################
+def _linear_fit(b1, y):
+    """
+    Closed form of fit_baseline for linear_model: y ~ m*b1 + b solved with
+    one lstsq, returned with the fields of a least_squares OptimizeResult
+    """
+    A = np.empty((b1.shape[0], 2))
+    A[:,0] = b1
+    A[:,1] = 1.0
+    x = np.linalg.lstsq(A, y, rcond=None)[0]
+    fun = y - A @ x
+    #Jacobian of the residual y - A@x
+    J = -A
+    grad = J.T @ fun
+    return OptimizeResult(x=x, cost=0.5*(fun @ fun), fun=fun, jac=J,
+            grad=grad, optimality=np.abs(grad).max(initial=0.0),
+            active_mask=np.zeros(2, dtype=int), nfev=1, njev=None, status=1,
+            message='Linear least squares solved in closed form.',
+            success=True)
+
+
 def fit_baseline(spectra, baseline, *intervals,
-        model= linear_model, parameters= (1.0, 0.0), index = False, dim=0):
+        model= linear_model, parameters= (1.0, 0.0), index = False, dim=0,
+        jac=None, method=None):
     """
     Return the optimal baseline for a spectra
  
@@ -375,6 +520,15 @@ def fit_baseline(spectra, baseline, *intervals,
         default linear_model(x, m=slope, b=intercept)
     parameters: model parameters
         default (m=1.0, b=0.0)
+    jac: func, optional
+        Jacobian of the residual jac(parameters, x, y), passed to
+        least_squares. With the default linear_model and no jac the fit
+        is solved in closed form (np.linalg.lstsq) and the OptimizeResult
+        carries the same fields.
+    method: str, optional
+        least_squares method. By default 'lm' (MINPACK) when an analytic
+        jac is given and there are at least as many points as parameters,
+        'trf' otherwise.
             
     Returns
     ___________________________________________________________________________ 
@@ -382,18 +536,31 @@ def fit_baseline(spectra, baseline, *intervals,
         References https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.least_squares.html#scipy.optimize.least_squares
     """
 
-    spectra = array_region(spectra, *intervals, index=index, dim=dim)
-    baseline = array_region(baseline, *intervals, index=index, dim=dim)
+    #both share the abscissa: the interval rows are found once
+    spectra, baseline = np.asarray(spectra), np.asarray(baseline)
+    if intervals:
+        slices = _interval_slices(spectra, intervals, index, dim)
+        spectra, baseline = _gather(spectra, slices), _gather(baseline, slices)
 
-    def __baseline_model(x, *parameters):
-        y = model(baseline[:,1], *parameters) 
-        return y
+    #columns are sliced once, not on every residual evaluation
+    b1 = baseline[:,1]
+    sx = spectra[:,0]
+    sy = spectra[:,1]
 
     def __res(parameters, x, y):
-        return y - __baseline_model(x, *parameters)
+        return y - model(b1, *parameters)
+
+    #linear in its parameters: no iterations needed when both m and b are fit
+    if jac is None and model is linear_model and len(parameters) == 2:
+        return _linear_fit(b1, sy)
 
+    #the fit is unbounded: with an exact Jacobian MINPACK's Levenberg-Marquardt
+    #converges in fewer evaluations than the trust region default
+    if method is None:
+        method = ('lm' if callable(jac) and sx.shape[0] >= len(parameters)
+                else 'trf')
     result = least_squares(__res, parameters,
-            args = (spectra[:,0], spectra[:,1]))
+            jac=jac or '2-point', method=method, args = (sx, sy))
     return result
 
 
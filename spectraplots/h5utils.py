@@ -1,5 +1,13 @@
+import os
 import sys
 import string
+import re
+import functools
+import contextlib
+import threading
+import warnings
+import zlib
+import concurrent.futures
 
 import numpy as np
 import h5py
@@ -7,6 +15,148 @@ import h5py
 ###############################################################################
 #access and Open h5 files
 ###############################################################################
+#defaults for h5py.File when opening by name, user kwargs take precedence.
+#64 MiB chunk cache with a prime number of slots keeps chunks hot between reads
+_FILE_DEFAULTS = {'rdcc_nbytes': 64*1024*1024,
+                  'rdcc_nslots': 521}
+#new files use the latest file format, paged file space and a page buffer,
+#so the many small attribute and metadata writes go out as whole 4 KiB
+#pages. No creation order index is kept on groups, it only slows the
+#writes down. Existing files keep the format they were written with
+_CREATE_MODES = ('w', 'w-', 'x')
+_CREATE_DEFAULTS = {'libver': 'latest',
+                    'fs_strategy': 'page',
+                    'fs_page_size': 4096,
+                    'page_buf_size': 16*1024*1024,
+                    'track_order': False}
+#options only understood by the Direct VFD (O_DIRECT, bypasses page cache)
+_DIRECT_KWARGS = ('alignment', 'block_size', 'cbuf_size')
+
+#files opened by name are shared: {realpath: [h5py.File, users, options]}.
+#A file is closed when its last user leaves, unless inside h5_leave_open
+_CACHED_MODES = ('r', 'r+', 'a')
+_OPEN_FILES = {}
+_OPEN_LOCK = threading.Lock()
+_leave_open = 0
+
+#chunks of a compressed dataset kept decompressed by _chunk_cached
+_CHUNKS_TO_CACHE = 4
+
+def _chunk_cached(h5_object, key, nbytes):
+    """
+    h5_object[key], reopened with its own chunk cache when it is a
+    compressed dataset and nbytes (the file chunk cache) cannot hold
+    _CHUNKS_TO_CACHE of its chunks, so partial reads do not inflate the
+    same chunk again and again.
+    """
+    h5_item = h5_object[key]
+    if (not isinstance(h5_item, h5py.Dataset) or h5_item.chunks is None
+            or h5_item.compression is None):
+        return h5_item
+    need = (_CHUNKS_TO_CACHE * int(np.prod(h5_item.chunks))
+            * h5_item.dtype.itemsize)
+    if need <= nbytes: return h5_item
+    #the access list only applies when HDF5 opens the dataset anew
+    name = h5_item.name.encode()
+    del h5_item
+    dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+    dapl.set_chunk_cache(_FILE_DEFAULTS['rdcc_nslots'], need, 0.75)
+    return h5py.Dataset(h5py.h5d.open(h5_object.file.id, name, dapl))
+
+def _open_collective(file_name, mode='r', comm=None, info=None,
+        libver=None, rdcc_nbytes=None, rdcc_nslots=None, rdcc_w0=0.75,
+        page_buf_size=None, min_meta_keep=0, min_raw_keep=0, **kwargs):
+    """
+    h5py.File on the mpio driver with collective metadata reads and writes,
+    which h5py.File does not expose. Requires h5py built with MPI.
+    """
+    if not h5py.get_config().mpi:
+        raise ValueError('collective_metadata needs h5py built with MPI')
+    if mode not in ('r', 'r+'):
+        raise ValueError("collective_metadata needs mode 'r' or 'r+'")
+    from mpi4py import MPI
+    fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    fapl.set_fapl_mpio(comm or MPI.COMM_WORLD, info or MPI.Info())
+    fapl.set_all_coll_metadata_ops(True)
+    fapl.set_coll_metadata_write(True)
+    if libver == 'latest':
+        fapl.set_libver_bounds(h5py.h5f.LIBVER_LATEST, h5py.h5f.LIBVER_LATEST)
+    if rdcc_nbytes or rdcc_nslots:
+        mdc, nslots, nbytes, w0 = fapl.get_cache()
+        fapl.set_cache(mdc, rdcc_nslots or nslots, rdcc_nbytes or nbytes,
+                rdcc_w0)
+    if page_buf_size:
+        fapl.set_page_buffer_size(page_buf_size, min_meta_keep, min_raw_keep)
+    flags = h5py.h5f.ACC_RDONLY if mode == 'r' else h5py.h5f.ACC_RDWR
+    return h5py.File(h5py.h5f.open(os.fsencode(file_name), flags, fapl=fapl))
+
+def _open_options(kwargs):
+    #every h5py.File option but the mode must match to share a handle
+    return {key: value for key, value in kwargs.items() if key != 'mode'}
+
+def _reusable(entry, mode, options):
+    h5_file = entry[0]
+    if not h5_file.id.valid or entry[2] != options: return False
+    return mode == 'r' or h5_file.mode == 'r+'
+
+def _open_shared(file_name, **kwargs):
+    """Return (h5py.File, cache path), reusing a compatible open handle"""
+    mode = kwargs.get('mode', 'r')
+    if kwargs.pop('collective_metadata', False):
+        return _open_collective(file_name, **kwargs), None
+    if mode not in _CACHED_MODES: return h5py.File(file_name, **kwargs), None
+    path = os.path.realpath(file_name)
+    options = _open_options(kwargs)
+    with _OPEN_LOCK:
+        entry = _OPEN_FILES.get(path)
+        if entry and not _reusable(entry, mode, options):
+            #still in use with another mode or other options (locking,
+            #chunk cache, driver...): open apart from the cache
+            if entry[0].id.valid and entry[1]:
+                return h5py.File(file_name, **kwargs), None
+            entry[0].close()
+            entry = None
+        if not entry:
+            entry = _OPEN_FILES[path] = [h5py.File(file_name, **kwargs), 0,
+                    options]
+        entry[1] += 1
+        return entry[0], path
+
+def _release_shared(path):
+    with _OPEN_LOCK:
+        entry = _OPEN_FILES.get(path)
+        if entry is None: return
+        entry[1] -= 1
+        if entry[1] <= 0 and not _leave_open:
+            entry[0].close()
+            del _OPEN_FILES[path]
+
+@contextlib.contextmanager
+def h5_leave_open():
+    """
+    Keep the files opened by name inside the block open until it ends, so
+    repeated calls on the same path reuse one handle and its metadata and
+    chunk caches instead of reopening the file.
+
+    Example:
+    --------
+    with h5_leave_open():
+        keys = _h5_keys('data.h5')
+        items = list(yield_items('data.h5', name_criteria=criteria))
+    """
+    global _leave_open
+    with _OPEN_LOCK: _leave_open += 1
+    try:
+        yield
+    finally:
+        with _OPEN_LOCK:
+            _leave_open -= 1
+            if not _leave_open:
+                for path, entry in list(_OPEN_FILES.items()):
+                    if entry[1] > 0: continue
+                    entry[0].close()
+                    del _OPEN_FILES[path]
+
 class h5FileContext:
     """
     A recursive context manager for working with HDF5 files and groups using the 'with' statement.
@@ -22,6 +172,27 @@ class h5FileContext:
 
     **kwargs : additional keyword arguments
         Additional keyword arguments to be passed when opening the HDF5 file (if applicable).
+        Unless overridden, files are opened with a 64 MiB chunk cache
+        (rdcc_nbytes/rdcc_nslots). Files created with mode 'w', 'w-' or 'x'
+        use libver='latest', fs_strategy='page' with 4 KiB pages, a 16 MiB
+        page buffer and track_order=False; reopen them with page_buf_size to
+        keep the buffer. Pass libver='earliest' (and fs_strategy=None) to
+        create files readable by HDF5 < 1.10.
+        driver='direct' (with alignment, block_size, cbuf_size) reads through
+        O_DIRECT, useful for one-pass batch reads of cold files on Linux. If
+        HDF5 was built without the Direct VFD the default driver is used.
+        page_buf_size (with min_meta_keep, min_raw_keep) enables the page
+        buffer of files created with fs_strategy='page' and driver='ros3'
+        (with aws_region, secret_id, secret_key) reads from S3, both go
+        straight to h5py.File. collective_metadata=True (with comm, info)
+        opens through the mpio driver with collective metadata reads and
+        writes for parallel file systems, it needs h5py built with MPI.
+
+    Files opened by name with mode 'r', 'r+' or 'a' are shared: a nested
+    context on the same path with the same options reuses the open handle
+    (other options get a handle of their own) and the file is closed when
+    the outermost context exits, or at the end of an enclosing
+    h5_leave_open block.
 
     Example:
     --------
@@ -40,30 +211,61 @@ class h5FileContext:
     def __init__(self, file_name_or_object, **kwargs):
         self.file_name_or_object = file_name_or_object
         self.kwargs = kwargs
+        #decided once: open by name or hand the object back as it is
+        self._by_name = isinstance(file_name_or_object, str)
 
     def __enter__(self):
-        if isinstance(self.file_name_or_object, h5py.File):
-            # User provided an already open HDF5 file
-            return self.file_name_or_object
-        elif isinstance(self.file_name_or_object, h5py.Group):
-            # User provided an already open HDF5 group
-            return self.file_name_or_object
-        elif isinstance(self.file_name_or_object, str):
+        if self._by_name:
             # User provided a file name, so open it
-            self.h5_file = h5py.File(self.file_name_or_object, **self.kwargs)
+            kwargs = {**_FILE_DEFAULTS, **self.kwargs}
+            if kwargs.get('mode') in _CREATE_MODES:
+                kwargs = {**_CREATE_DEFAULTS, **kwargs}
+                #HDF5 refuses a page buffer on other file space strategies
+                if (kwargs['fs_strategy'] != 'page'
+                        and 'page_buf_size' not in self.kwargs):
+                    kwargs.pop('page_buf_size')
+            if (kwargs.get('driver') == 'direct'
+                    and 'direct' not in h5py.registered_drivers()):
+                kwargs.pop('driver')
+                for key in _DIRECT_KWARGS: kwargs.pop(key, None)
+            self.h5_file, self.path = _open_shared(self.file_name_or_object,
+                    **kwargs)
             return self.h5_file
+        elif isinstance(self.file_name_or_object, h5py.Group):
+            # User provided an already open HDF5 file or group
+            return self.file_name_or_object
         else:
             raise TypeError("Unsupported type for 'file_name_or_object'. Must be an H5 file or a string file name.")
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if isinstance(self.file_name_or_object, str):
-            self.h5_file.close()
+        if self._by_name:
+            if self.path is None: self.h5_file.close()
+            else: _release_shared(self.path)
 
 
 def _access_h5(file_name_or_object, mode='r', **kwargs):
     return h5FileContext(file_name_or_object, mode=mode, **kwargs)
 
 
+def _walk(h5_object, deep):
+    """
+    Absolute names of the groups and datasets below h5_object up to deep
+    levels, a negative deep means no limit
+    """
+    #h5o.visit hands over raw names and object types, so no Group/Dataset
+    #is instantiated per node as visititems does. Names are interned: the
+    #same paths come back from every walk and are used as dict keys
+    if deep == 0: return []
+    if deep < 0: deep = sys.maxsize
+    prefix = h5_object.name.rstrip('/') + '/'
+    kinds = (h5py.h5o.TYPE_GROUP, h5py.h5o.TYPE_DATASET)
+    names = []
+    def _visit(name, info):
+        if name.count(b'/') < deep and info.type in kinds:
+            names.append(sys.intern(prefix + name.decode()))
+    h5py.h5o.visit(h5_object.id, _visit, info=True)
+    return names
+
 def _all_keys(file_name_or_object, deep = 10, mode = 'r' ):
     """
     Recursively find all keys (dataset paths) in an h5py Group.
@@ -101,17 +303,11 @@ def _all_keys(file_name_or_object, deep = 10, mode = 'r' ):
     for key in keys:
         print(f'Dataset Path: {key}')
     """
-    with __access_h5(file_name_or_object, mode = mode) as h5_object:
-        keys = (h5_object.name,)
-        deep  = abs(deep) #for bool(0jj)
-        if bool(deep):
-            deep -= 1
-            for key, value in h5_object.items():
-                if isinstance(value, h5py.Group):
-                    keys = keys + __all_keys(value, deep, mode=mode)
-                elif isinstance(value, h5py.Dataset):
-                    keys = keys + (value.name,)
-    return keys
+    #a single C-level walk (H5Ovisit) fills one list, depth is the number
+    #of '/' in the name relative to the starting group
+    with _access_h5(file_name_or_object, mode = mode) as h5_object:
+        keys = [sys.intern(h5_object.name)] + _walk(h5_object, deep)
+    return tuple(keys)
 
 
 def yield_items(file_name_or_object, name_criteria = None,
@@ -144,6 +340,8 @@ def yield_items(file_name_or_object, name_criteria = None,
 
     func : function, optional
         A user-defined function to apply to each matching dataset or group.
+        To read many datasets of the same shape, bind a preallocated buffer
+        with `read_direct_into` instead of slicing each dataset.
 
     **kwargs : additional keyword arguments
         Additional keyword arguments to pass to the underlying `_access_h5` function.
@@ -178,46 +376,53 @@ def yield_items(file_name_or_object, name_criteria = None,
     for item in yield_items('data.h5', deep=-1, func=process_item):
         pass
     """
-    def __default_criteria(path):
-        return True
-    name_criteria = name_criteria or __default_criteria
-    object_criteria = object_criteria or __default_criteria
-    func = func or __default_criteria
+    name_criteria = name_criteria or _default_criteria
+    object_criteria = object_criteria or _default_criteria
+    func = func or _default_func
+
+    #the defaults always pass (or do nothing): skip calling them per node
+    check_name = name_criteria is not _default_criteria
+    check_object = object_criteria is not _default_criteria
+    call_func = func is not _default_func
 
     with _access_h5(file_name_or_object, mode = mode, **kwargs) as h5_object:
         if object_criteria(h5_object) and name_criteria(h5_object.name):
             func(h5_object)
             yield  h5_object
-        deep  = abs(deep) #for bool(0jj)
-        if bool(deep):
-            deep -= 1
-            for key, value in h5_object.items():
-                key = value.name
-                if isinstance(value, h5py.Group):
-                    yield from yield_items(value, deep=deep, mode=mode,
-                            name_criteria=name_criteria,
-                            object_criteria=object_criteria, func=func)
-                elif (isinstance(value, h5py.Dataset) and
-                        object_criteria(value) and
-                        name_criteria(key)):
-                    func(value)
-                    yield value
+        #names are filtered before any h5py object is built for them
+        for name in _walk(h5_object, deep):
+            if check_name and not name_criteria(name): continue
+            value = h5_object[name]
+            if check_object and not object_criteria(value): continue
+            if call_func: func(value)
+            yield value
 
 
 def _h5_keys(file_name_or_object, name_criteria = None, object_criteria = None,
         deep = 10):
     """Return names of the h5_obj with criteria name and object"""
-    def __default_criteria(path):
-        return True
-    name_criteria = name_criteria or __default_criteria
-    object_criteria = object_criteria or __default_criteria
-
-    names = __all_keys(file_name_or_object, deep = deep)
-    with access_h5(file_name_or_object, mode='r') as h5_object:
-        names_criteria = [name for name in names
-                if object_criteria(h5_object.get(name)) and name_criteria(name)]
+    name_criteria = name_criteria or _default_criteria
+    object_criteria = object_criteria or _default_criteria
+
+    #open once and filter while walking, instead of listing every key and
+    #then reopening the file to look each one up again
+    with _access_h5(file_name_or_object, mode='r') as h5_object:
+        names_criteria = [sys.intern(item.name) for item in yield_items(
+                h5_object, name_criteria=name_criteria,
+                object_criteria=object_criteria, deep=deep)]
     return names_criteria
 
+def map_files(paths, func, workers=8):
+    """
+    Apply func to every path with a thread pool and return the results in
+    the order of paths, e.g. map_files(paths, lambda p: _h5_keys(p)).
+    Each call should open its own file: h5py serialises its calls with a
+    global lock, so the gain comes from overlapping the disk reads and the
+    Python work done outside h5py, not from parallel HDF5 calls.
+    """
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(func, paths))
+
 ###############################################################################
 #criterias for hdf5 files
 ###############################################################################
@@ -237,47 +442,106 @@ def is_root(name):
     return name == '/'
 
 
+@functools.lru_cache(maxsize=256)
+def _union_re(patterns, anchor=''):
+    #one alternation per pattern set: 'start' -> match, 'end' -> search at \Z
+    union= '(?:' + '|'.join(map(re.escape, patterns)) + ')'
+    if anchor == 'end': union+= r'\Z'
+    return re.compile(union)
+
+def _union_found(path, patterns, anchor=''):
+    regex= _union_re(tuple(patterns), anchor)
+    if anchor == 'start': return regex.match(path) is not None
+    return regex.search(path) is not None
+
 def criteria_name(
         path, in_path=[] , not_in_path=[],
         starts = [], ends = [], not_starts = [], not_ends = [],
         operator = 'and'):
     """
     """
-    if operator == 'and':
-        operator= np.prod
-    elif operator == 'or':
-        operator= np.sum
-    else:
-        operator= np.sum
+    #'and' -> all, anything else -> any. Each pattern list collapses into a
+    #single compiled regex when the operator allows it (any of the positive
+    #clauses, all of the negated ones); otherwise all/any short-circuit
+    join_all= operator == 'and'
+
+    #clauses are always joined with 'and': stop at the first failing one
+    if in_path:
+        if join_all: found= all(include in path for include in in_path)
+        else: found= _union_found(path, in_path)
+        if not found: return False
+    if starts:
+        if join_all: found= all(path.startswith(c) for c in starts)
+        else: found= _union_found(path, starts, 'start')
+        if not found: return False
+    if ends:
+        if join_all: found= all(path.endswith(c) for c in ends)
+        else: found= _union_found(path, ends, 'end')
+        if not found: return False
+    if not_in_path:
+        if join_all: found= not _union_found(path, not_in_path)
+        else: found= any(not_inc not in path for not_inc in not_in_path)
+        if not found: return False
+    if not_starts:
+        if join_all: found= not _union_found(path, not_starts, 'start')
+        else: found= any(not path.startswith(c) for c in not_starts)
+        if not found: return False
+    if not_ends:
+        if join_all: found= not _union_found(path, not_ends, 'end')
+        else: found= any(not path.endswith(c) for c in not_ends)
+        if not found: return False
+    return True
+
+def make_criteria_name(in_path=(), not_in_path=(), starts=(), ends=(),
+        not_starts=(), not_ends=(), operator='and'):
+    """
+    Return a name_criteria predicate equivalent to
+    lambda path: criteria_name(path, in_path, not_in_path, starts, ends,
+                               not_starts, not_ends, operator)
+    with the clauses resolved once: empty lists are dropped and pattern
+    lists become tuple startswith/endswith calls or one compiled regex.
+
+    Example:
+    --------
+    criteria = make_criteria_name(starts=['/sample'], not_ends=['_bg'])
+    keys = _h5_keys('data.h5', name_criteria=criteria)
+    """
+    join_all = operator == 'and'
+    in_path, not_in_path = tuple(in_path), tuple(not_in_path)
+    starts, ends = tuple(starts), tuple(ends)
+    not_starts, not_ends = tuple(not_starts), tuple(not_ends)
 
+    checks = []
     if in_path:
-        __in_path = bool(operator(np.array(
-            [(include in path) for include in in_path])))
-    else: __in_path = True
+        if join_all:
+            checks.append(lambda path: all(s in path for s in in_path))
+        else:
+            search = _union_re(in_path).search
+            checks.append(lambda path: search(path) is not None)
     if starts:
-        __starts = bool(operator(np.array(
-            [path.startswith(criteria) for criteria in starts])))
-    else: __starts = True
+        if join_all:
+            checks.append(lambda path: all(map(path.startswith, starts)))
+        else: checks.append(lambda path: path.startswith(starts))
     if ends:
-        __ends =  bool(operator(np.array(
-            [path.endswith(criteria) for criteria in ends])))
-    else: __ends = True
+        if join_all: checks.append(lambda path: all(map(path.endswith, ends)))
+        else: checks.append(lambda path: path.endswith(ends))
     if not_in_path:
-        __not_in_path = bool(operator(np.array(
-            [not(not_inc in path) for not_inc in not_in_path])))
-    else: __not_in_path = True
+        if join_all:
+            search_not = _union_re(not_in_path).search
+            checks.append(lambda path: search_not(path) is None)
+        else:
+            checks.append(lambda path: any(s not in path for s in not_in_path))
     if not_starts:
-        __not_starts = bool(operator(np.array(
-            [not(path.startswith(criteria)) for criteria in not_starts])))
-    else: __not_starts = True 
+        if join_all: checks.append(lambda path: not path.startswith(not_starts))
+        else: checks.append(lambda path:
+                not all(map(path.startswith, not_starts)))
     if not_ends:
-        __not_ends =  bool(operator(np.array(
-            [not(path.endswith(criteria)) for criteria in not_ends])) )
-    else: __not_ends = True 
-    
-    satisfy = (__in_path and __not_in_path and  __starts and  __not_starts
-            and __ends and __not_ends)
-    return satisfy
+        if join_all: checks.append(lambda path: not path.endswith(not_ends))
+        else: checks.append(lambda path: not all(map(path.endswith, not_ends)))
+
+    if not checks: return _default_criteria
+    if len(checks) == 1: return checks[0]
+    return lambda path: all(check(path) for check in checks)
 
 ###############################################################################
 #for create or modify hdf5 files 
@@ -285,6 +549,63 @@ def criteria_name(
 def _default_func(h5_object):
     return None
 
+def _memmap_dataset(dataset, mode='r'):
+    """
+    dataset as a numpy.memmap (mode 'r' or copy-on-write 'c') over its file
+    when it is stored contiguously, else read into memory. See
+    h5Utils.mmap_dataset.
+    """
+    offset = dataset.id.get_offset()
+    if (dataset.chunks is not None or offset is None
+            or dataset.dtype.hasobject
+            or dataset.file.driver not in ('sec2', 'stdio')):
+        return dataset[()]
+    return np.memmap(dataset.file.filename, mode=mode, dtype=dataset.dtype,
+            offset=offset, shape=dataset.shape)
+
+
+def read_direct_into(dataset, out):
+    """
+    Read a whole dataset into a preallocated numpy array and return it.
+    Reuse the same `out` (np.empty(shape, dtype)) across datasets of equal
+    shape to avoid one allocation per dataset, e.g. as a `func` hook:
+    func = lambda dataset: read_direct_into(dataset, buffer)
+    """
+    dataset.read_direct(out)
+    return out
+
+
+#digits with an optional decimal part, used by string_to_float
+_NUMBER_RE = re.compile(r'[0-9]+(?:\.[0-9]+)?')
+
+
+@functools.lru_cache(maxsize=None)
+def _drop_table(dot):
+    """Translation table removing letters and punctuation except dot"""
+    return str.maketrans('', '', string.ascii_letters
+            + string.punctuation.replace(dot, ''))
+
+@functools.lru_cache(maxsize=None)
+def _drop_bytes(dot):
+    """Same characters as _drop_table for bytes.translate"""
+    return (string.ascii_letters + string.punctuation.replace(dot, '')).encode()
+
+def _clean_number(number_string, dot):
+    #ascii names (the usual case) go through bytes.translate, a flat 256
+    #entry table, instead of the per character dict lookups of str.translate
+    if number_string.isascii():
+        return (number_string.encode().translate(None, _drop_bytes(dot))
+                .replace(dot.encode(), b'.').decode())
+    return number_string.translate(_drop_table(dot)).replace(dot, '.')
+
+
+#dataset names repeat across sweeps and the conversion is pure: cache it.
+#Always called positionally so one string has one cache key
+@functools.lru_cache(maxsize=4096)
+def _parse_number(number_string, dot):
+    #clean number_string in one C-level pass and take the first number
+    match = _NUMBER_RE.search(_clean_number(number_string, dot))
+    return float(match.group()) if match else float('Nan')
 
 def string_to_float(number_string, dot='_'):
     """
@@ -312,42 +633,115 @@ def string_to_float(number_string, dot='_'):
     --------
     # Handle a poorly formatted number string
     result = string_to_float("abc12345_67def")
-    print(result)  # Output: 12345.64
-    """
-    #clean number_string
-    alphabet = list(string.ascii_letters)
-    symbols = list(string.punctuation.replace(dot,''))
-    name = number_string
-    for letter in alphabet:
-        number_string = number_string.replace(letter, '')
-    for symbol in symbols:
-        number_string = number_string.replace(symbol, '')
-        
-    number_string = number_string.replace(dot, '.')
-
-    #avoid starting dots
-    starts = 0
-    ends = len(number_string)
-    for i, s in enumerate(number_string):
-        if s in string.digits:
-            starts=i
-            break
-    #avoid multiple dots
-    dots=0
-    for i, s in enumerate(number_string[starts:]):
-        if s in '.' and dots==1:
-            ends=i
-            dots+=1
-        elif s in '.':
-            dots += 1
+    print(result)  # Output: 12345.67
+    """
+    number = _parse_number(number_string, dot)
+    #reported on every call, cached or not
+    if number != number:
+        print(f' String to float failed in "{number_string}"\n',
+                f'String try:{_clean_number(number_string, dot)}')
+    return number
+
+#first number of every line, empty group when the line has none
+_LINE_NUMBER_RE = re.compile(r'^[^0-9\n]*([0-9]+(?:\.[0-9]+)?)?', re.MULTILINE)
 
+def strings_to_float(number_strings, dot='_'):
+    """
+    string_to_float over a sequence of strings, returned as a float64 array.
+    The strings are cleaned with one translate and parsed with one regex
+    pass over their concatenation instead of once per string.
+    """
+    number_strings = list(number_strings)
+    if not number_strings: return np.empty(0)
+    if any('\n' in number_string for number_string in number_strings):
+        return np.array([string_to_float(number_string, dot)
+            for number_string in number_strings], dtype=np.float64)
+    numbers = _LINE_NUMBER_RE.findall(
+            _clean_number('\n'.join(number_strings), dot))
+    values = np.full(len(number_strings), np.nan)
+    for i, number in enumerate(numbers):
+        if number: values[i] = float(number)
+        else: string_to_float(number_strings[i], dot)  #reports the failure
+    return values
+
+def iter_chunks(dataset):
+    """
+    Return the StoreInfo (chunk_offset, filter_mask, byte_offset, size) of
+    every allocated chunk of a chunked dataset. Prefer this over looping on
+    get_chunk_info(i), which costs a linear search per call: chunk_iter walks
+    the chunk index once (h5py >= 3.8 built with HDF5 >= 1.12.3).
+    """
+    dsid = dataset.id
+    chunks = []
     try:
-        number = float(number_string[starts:starts+ends])
-    except:
-        print(f' String to float failed in "{name}"\n',
-                f'String try:{number_string[starts:ends]}')
-        number = float('Nan')
-    return number
+        dsid.chunk_iter(chunks.append)
+    except AttributeError:
+        warnings.warn('chunk_iter is not available (needs h5py >= 3.8 and '
+                'HDF5 >= 1.12.3), listing chunks one by one', RuntimeWarning)
+        chunks = [dsid.get_chunk_info(i) for i in range(dsid.get_num_chunks())]
+    return chunks
+
+def read_many(dataset, slices):
+    """
+    Read several slices along the first axis of a dataset with one read.
+    The slices are joined into a single hyperslab selection, so rows come
+    back once each and in file order (overlaps are not repeated).
+
+    Parameters:
+    -----------
+    dataset : h5py.Dataset
+    slices : iterable of slice
+        Slices over the first axis, negative steps are not supported.
+
+    Returns:
+    --------
+    numpy.ndarray with shape (selected rows, *dataset.shape[1:])
+    """
+    nrows, rest = dataset.shape[0], dataset.shape[1:]
+    zeros, ones = (0,)*len(rest), (1,)*len(rest)
+    file_space = dataset.id.get_space()
+    file_space.select_none()
+    for slide in slices:
+        start, stop, step = slide.indices(nrows)
+        if step < 1: raise ValueError('read_many only supports positive steps')
+        count = len(range(start, stop, step))
+        if not count: continue
+        file_space.select_hyperslab((start,)+zeros, (count,)+rest,
+                stride=(step,)+ones, op=h5py.h5s.SELECT_OR)
+    size = int(np.prod(rest))
+    selected = file_space.get_select_npoints()//size if size else 0
+    out = np.empty((selected,)+rest, dtype=dataset.dtype)
+    if out.size:
+        dataset.id.read(h5py.h5s.create_simple(out.shape), file_space, out)
+    return out
+
+def _only_deflate(dataset):
+    """True for chunked numeric datasets whose only filter is gzip"""
+    if dataset.chunks is None or dataset.dtype.kind not in 'biuf': return False
+    plist = dataset.id.get_create_plist()
+    return (plist.get_nfilters() == 1
+            and plist.get_filter(0)[0] == h5py.h5z.FILTER_DEFLATE)
+
+def _read_deflated(dataset, executor):
+    """
+    Read a gzip-only chunked dataset fetching the raw chunks in the caller
+    and inflating them in executor: zlib releases the GIL, so the threads
+    decompress in parallel while h5py stays serialised.
+    """
+    shape, chunk = dataset.shape, dataset.chunks
+    out = np.full(shape, dataset.fillvalue, dtype=dataset.dtype)
+    raw = [(info.chunk_offset, dataset.id.read_direct_chunk(info.chunk_offset))
+            for info in iter_chunks(dataset)]
+    def _inflate(item):
+        offset, (filter_mask, data) = item
+        #bit 0 set: deflate was skipped for this chunk
+        if not filter_mask & 1: data = zlib.decompress(data)
+        block = np.frombuffer(data, dtype=dataset.dtype).reshape(chunk)
+        target = tuple(slice(o, min(o + c, n))
+                for o, c, n in zip(offset, chunk, shape))
+        out[target] = block[tuple(slice(0, t.stop - t.start) for t in target)]
+    list(executor.map(_inflate, raw))
+    return out
 
 def _apply_attributes(file_name_or_object, keys,  attribute_name,
         criteria=False, func=string_to_float, start=None, end=None, step=None):
@@ -366,18 +760,48 @@ def _apply_attributes(file_name_or_object, keys,  attribute_name,
     rule: func
           Method to choose the attribute value with key file 
     """
-    with __access_h5(file_name_or_object, mode='r+') as h5_object:
-        if not(criteria): criteria= __default_criteria
-        slide = slice(start, end, step)
-        
-        for key in keys:
-            key_short = key[slide]
-            attribute = func(key_short)
-            h5_object.get(key).attrs.create(attribute_name, np.float64(attribute))
+    with _access_h5(file_name_or_object, mode='r+') as h5_object:
+        if not(criteria): criteria= _default_criteria
+        slide = make_slide(start, end, step)
+        #the scalar float64 dataspace and type are created once and reused
+        #by the low level h5a calls, parents are resolved once per group
+        name = attribute_name.encode()
+        space = h5py.h5s.create(h5py.h5s.SCALAR)
+        tid = h5py.h5t.NATIVE_DOUBLE
+        value = np.empty((), dtype=np.float64)
+        parents = {}
+        keys = sorted(keys)
+        if func is string_to_float:
+            attributes = strings_to_float([key[slide] for key in keys])
+        else:
+            attributes = [func(key[slide]) for key in keys]
+
+        for key, attribute in zip(keys, attributes):
+            head, sep, leaf = key.rpartition('/')
+            #'/' (or a trailing '/') names the group itself, not a child
+            if not leaf: oid = h5_object[key or '.'].id
+            else:
+                parent_key = head or sep or '.'
+                parent = parents.get(parent_key)
+                if parent is None:
+                    parent = parents[parent_key] = h5_object[parent_key]
+                oid = parent[leaf].id
+            if h5py.h5a.exists(oid, name): h5py.h5a.delete(oid, name)
+            attr = h5py.h5a.create(oid, name, tid, space)
+            value[()] = attribute
+            attr.write(value)
+        #one sync point for the whole batch; with a shared handle the file
+        #may stay open after this context
+        h5_object.file.flush()
     return file_name_or_object
 
+@functools.lru_cache(maxsize=None)
+def make_slide(start=None, end=None, step=None):
+    """Return a shared slice(start, end, step) to pass as slide= in loops"""
+    return slice(start, end, step)
+
 def apply_name_attribute(h5_object, attribute_name, func=string_to_float,
-        start = None, end=None, step=None, confirm=True):
+        start = None, end=None, step=None, confirm=True, slide=None):
    """
    apply_name_attribute
    Create a hdf5 attribute with the h5_object name with a rule the default 
@@ -401,11 +825,14 @@ def apply_name_attribute(h5_object, attribute_name, func=string_to_float,
         Step of character in h5_obj.name
    confirm:Bool
            Confirms the creation of the attribute
+   slide:slice
+         Used instead of start, end and step when given, build it once with
+         make_slide when calling this in a loop
    """
-   slide = slice(start, end, step)
+   if slide is None: slide = make_slide(start, end, step)
    attribute = func(h5_object.name[slide])
    if confirm:
-       h5_object.attrs.create(attribute_name, np.float64(attribute))
+       h5_object.attrs.create(attribute_name, attribute, dtype='f8')
    return attribute
 
 
@@ -420,6 +847,7 @@ class h5Utils():
        self.func = func or _default_func 
        self.keys = keys
        self.kwargs = kwargs
+       self._context = self._h5 = None
 
     @property
     def file_name_or_object(self):
@@ -427,14 +855,8 @@ class h5Utils():
 
     @file_name_or_object.setter
     def file_name_or_object(self, file_name_or_object):
-        if isinstance(file_name_or_object, h5py.File):
-            # User provided an already open HDF5 file
-            self._file_name_or_object = file_name_or_object
-        elif isinstance(file_name_or_object, h5py.Group):
-            # User provided an already open HDF5 group
-            self._file_name_or_object = file_name_or_object
-        elif isinstance(file_name_or_object, str):
-            # User provided a file name, so open it
+        #h5py.File is a Group, one check covers both open objects
+        if isinstance(file_name_or_object, (str, h5py.Group)):
             self._file_name_or_object = file_name_or_object
         else:
             raise TypeError("Unsupported type for 'file_name_or_object'. Must be an H5 object (File or Group) or a string file name.")
@@ -477,10 +899,41 @@ class h5Utils():
         self.deep = deep or self.deep
         self.func = func or self.func
         self.keys = keys or self.keys 
-        self.kwargs = kwargs
+        self.kwargs = kwargs or self.kwargs
         return self
 
+    def open(self, *, mode=None):
+        """
+        Open the file once and reuse the handle in every method until close,
+        instead of opening it per call. Also usable as `with h5Utils(...)`.
+        """
+        if self._context is None:
+            self.mode = mode or self.mode
+            self._context = _access_h5(self.file_name_or_object,
+                    mode=self.mode, **self.kwargs)
+            self._h5 = self._context.__enter__()
+        return self._h5
+
+    def close(self):
+        if self._context is not None:
+            self._context.__exit__(None, None, None)
+        self._context = self._h5 = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _source(self):
+        #the handle from open() when there is one, else the name or object
+        if self._h5 is not None: return self._h5
+        return self.file_name_or_object
+
     def access_h5(self, *,mode = None):
+        #an opened handle is reused whatever the mode asked for
+        if self._h5 is not None: return _access_h5(self._h5)
         self.mode = mode or self.mode
         return _access_h5(self.file_name_or_object, mode=self.mode, **self.kwargs)
 
@@ -490,7 +943,7 @@ class h5Utils():
         """
         See yield_items
         """
-        file_name_or_object = self.file_name_or_object
+        file_name_or_object = self._source()
         mode = mode or self.mode
         name_criteria = name_criteria or self.name_criteria
         object_criteria = object_criteria or self.object_criteria
@@ -500,7 +953,7 @@ class h5Utils():
         return yield_items(file_name_or_object,
                 name_criteria=name_criteria,
                 object_criteria=object_criteria,
-                deep=deep, mode=mode, func=func)
+                deep=deep, mode=mode, func=func, **self.kwargs)
 
     def mk_keys(self, *,name_criteria=None,
             object_criteria=None, deep=None,
@@ -520,25 +973,169 @@ class h5Utils():
         """
         self.set_kwargs(mode=mode, name_criteria=name_criteria, 
                 object_criteria=object_criteria, deep=deep, func=func)
-        keys = ()
-        for h5_object in self.select_items(func=_default_criteria):
-            keys = keys + (h5_object.name,)
+        keys = [sys.intern(h5_object.name)
+                for h5_object in self.select_items(func=_default_func)]
 
         if self.func != _default_func:
+            #one func call per key, then a stable argsort (NaN last) when
+            #the values are numbers; strings and others keep their own order
             with self.access_h5() as h5_obj:
-                _func = lambda key: self.func(h5_obj, key)
-                keys = sorted(keys, key=_func)
-        self.keys = keys
-        return keys 
+                values = [self.func(h5_obj, key) for key in keys]
+            try: numbers = np.asarray(values)
+            except ValueError: numbers = None
+            if (numbers is not None and numbers.ndim == 1
+                    and numbers.dtype.kind in 'biuf'):
+                keys = [keys[i] for i in np.argsort(numbers, kind='stable')]
+            else:
+                keys = [key for _, key in
+                        sorted(zip(values, keys), key=lambda pair: pair[0])]
+        self.keys = tuple(keys)
+        return self.keys
 
     def apply_keys(self, keys=None, mode=None ,func=None):
         keys = keys or self.keys
         func = func or self.func
         mode = mode or self.mode
         with self.access_h5(mode=mode) as h5_object:
+            nbytes = h5_object.file.id.get_access_plist().get_cache()[2]
             for  key in keys:
-                if func:
-                    func(h5_object.get(key))
-                    yield h5_object.get(key)
-                else:
-                    yield h5_object.get(key)
+                #resolve the path once, missing keys are skipped
+                try: h5_item = _chunk_cached(h5_object, key, nbytes)
+                except KeyError: continue
+                if func and func is not _default_func: func(h5_item)
+                yield h5_item
+
+    def apply_keys_parallel(self, keys=None, mode=None, func=None, workers=8):
+        """
+        Read the datasets in keys with a thread pool and return the arrays in
+        the order of keys, calling func on each array from the pool. Chunks of
+        gzip-only datasets are inflated in parallel, other datasets are read
+        whole; HDF5 calls themselves stay serialised by h5py.
+        """
+        keys = keys or self.keys
+        func = func or self.func
+        mode = mode or self.mode
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            with self.access_h5(mode=mode) as h5_object:
+                arrays = []
+                for key in keys:
+                    dataset = h5_object[key]
+                    if _only_deflate(dataset):
+                        arrays.append(_read_deflated(dataset, executor))
+                    else: arrays.append(dataset[()])
+            if func: list(executor.map(func, arrays))
+        return arrays
+
+    def apply_keys_chunks(self, keys=None, mode=None, func=None):
+        """
+        Like apply_keys for chunk level work: func(dataset, chunk_info) is
+        called for every stored chunk of each chunked dataset in keys, with
+        the chunk list from iter_chunks (one walk of the chunk index).
+        Yields the datasets.
+        """
+        keys = keys or self.keys
+        func = func or self.func
+        mode = mode or self.mode
+        with self.access_h5(mode=mode) as h5_object:
+            for key in keys:
+                try: dataset = h5_object[key]
+                except KeyError: continue
+                if not is_dataset(dataset): continue
+                if dataset.chunks is not None:
+                    for chunk_info in iter_chunks(dataset):
+                        func(dataset, chunk_info)
+                yield dataset
+
+    def apply_keys_lazy(self, keys=None, mode=None, chunks='auto'):
+        """
+        Yield dask arrays wrapping the datasets in keys, aligned to the
+        dataset chunks when they are chunked (chunks otherwise). A group
+        yields a dict {name: dask array} of its datasets. Nothing is read
+        until compute; the file must still be open by then, so consume the
+        arrays while iterating, pass an open File or use h5_leave_open.
+        Requires dask.
+        """
+        import dask.array as da
+        keys = keys or self.keys
+        mode = mode or self.mode
+        _lazy = lambda dataset: da.from_array(dataset,
+                chunks=dataset.chunks or chunks)
+        with self.access_h5(mode=mode) as h5_object:
+            for key in keys:
+                try: h5_item = h5_object[key]
+                except KeyError: continue
+                if is_dataset(h5_item): yield _lazy(h5_item)
+                else: yield {name: _lazy(value)
+                        for name, value in h5_item.items() if is_dataset(value)}
+
+    def apply_bulk_attribute(self, attribute_name, keys=None,
+            func=string_to_float, slide=None):
+        """
+        Store func(key[slide]) for every key as one table dataset
+        /_attrs/<attribute_name> with fields (path, value), written with a
+        single dataset write instead of one attribute per object. Read it
+        back with lookup_attribute. The /_attrs group is part of the file
+        tree, exclude it with the name criteria when traversing.
+        """
+        keys = list(keys or self.keys)
+        slide = slide or make_slide()
+        if func is string_to_float:
+            values = strings_to_float([key[slide] for key in keys])
+        else:
+            values = np.fromiter((func(key[slide]) for key in keys),
+                    dtype=np.float64, count=len(keys))
+        table = np.empty(len(keys),
+                dtype=[('path', h5py.string_dtype()), ('value', 'f8')])
+        table['path'] = keys
+        table['value'] = values
+        with _access_h5(self._source(), mode='r+',
+                **self.kwargs) as h5_object:
+            group = h5_object.file.require_group('_attrs')
+            if attribute_name in group: del group[attribute_name]
+            group.create_dataset(attribute_name, data=table)
+        return values
+
+    def lookup_attribute(self, attribute_name):
+        """Return {path: value} from the table made by apply_bulk_attribute"""
+        with _access_h5(self._source(), **self.kwargs) as h5_object:
+            table = h5_object.file['_attrs'][attribute_name][()]
+        return {path.decode(): value for path, value in
+                zip(table['path'].tolist(), table['value'].tolist())}
+
+    def mmap_dataset(self, key):
+        """
+        Return the dataset key as a read-only numpy.memmap over the file when
+        it is stored contiguously (no chunks or filters, allocated, fixed
+        size dtype): slices are then served from the page cache with no
+        copy. Other datasets are read into memory.
+        """
+        with self.access_h5(mode='r') as h5_object:
+            return _memmap_dataset(h5_object[key])
+
+    def apply_keys_bulk(self, keys=None, mode=None, func=None, dtype=None):
+        """
+        Read the datasets in keys, which must share shape, into one
+        preallocated array of shape (len(keys), *shape) and call func once
+        on that batch instead of once per dataset. Returns the batch.
+        dtype defaults to the dtype of the first dataset, HDF5 converts the
+        others while reading.
+        """
+        keys = keys or self.keys
+        func = func or self.func
+        mode = mode or self.mode
+        with self.access_h5(mode=mode) as h5_object:
+            datasets = [h5_object[key] for key in keys]
+            if not datasets: return np.empty((0,), dtype=dtype)
+            batch = np.empty((len(datasets),) + datasets[0].shape,
+                    dtype=dtype or datasets[0].dtype)
+            for row, dataset in zip(batch, datasets): dataset.read_direct(row)
+        if func: func(batch)
+        return batch
+
+    def stack(self, keys=None, dtype=None):
+        """
+        Stack the datasets in keys (default self.keys), e.g. 1-D spectra of
+        equal length, as the rows of one array read in place with
+        read_direct. See apply_keys_bulk.
+        """
+        return self.apply_keys_bulk(keys, func=_default_func, dtype=dtype)
@@ -4,6 +4,10 @@ import sys
 import os.path
 import pathlib
 import time
+import functools
+import concurrent.futures
+import warnings
+import weakref
 
 
 import numpy as np
@@ -17,14 +21,12 @@ from matplotlib.ticker import FormatStrFormatter
 from matplotlib import style
 from matplotlib.patches import Rectangle
 from matplotlib.patches import ConnectionPatch
-import ipywidgets as widgets
-from lmfit import Parameters, Model
-from lmfit.model import load_model
-from lmfit.models import LorentzianModel, ThermalDistributionModel
-from tables import file
+from matplotlib.collections import PatchCollection, LineCollection
 
 
-from .h5utils import criteria_name, is_dataset, is_group, h5Utils
+from .h5utils import (criteria_name, is_dataset, is_group, h5Utils,
+        _FILE_DEFAULTS, _access_h5, _chunk_cached, _only_deflate,
+        _read_deflated)
 from .analysis import find_near, array_region, fit_baseline, nm_to_ev
 
 
@@ -65,8 +67,81 @@ markers = [
 
 #Spectrscopy plots
 ###############################################################################
+def _read_xy(dataset):
+    """
+    Energy and intensity columns of a spectrum dataset, read straight into
+    a preallocated (n, 2) array instead of going through np.array(dataset)
+    """
+    xy = np.empty((dataset.shape[0], 2), dtype=dataset.dtype)
+    if xy.size: dataset.read_direct(xy, np.s_[:, :2])
+    return xy
+
+
+def _spectra_axes(ax, figsize, constrained_layout=True):
+    """New axes, or the given ones without legend to reuse them"""
+    if ax is None:
+        fig, ax = plt.subplots(figsize=figsize,
+                constrained_layout= constrained_layout)
+        return ax
+    if ax.get_legend(): ax.get_legend().remove()
+    return ax
+
+
+def _draw_lines(ax, lines, **kwargs):
+    """
+    Plot (x, y, label) lines. Reused axes with as many lines keep them and
+    only get new data (for interactive_spectra), otherwise they are replaced
+    """
+    if ax.lines and len(ax.lines) == len(lines):
+        for line, (x, y, label) in zip(ax.lines, lines):
+            line.set_data(x, y)
+            line.set(label=label, **kwargs)
+        return None
+    [l.remove() for l in ax.lines]
+    for x, y, label in lines: ax.plot(x, y, label=label, **kwargs)
+    return None
+
+
+#{axes: (bbox bounds, xlim, ylim, background without lines)} for _redraw
+_BACKGROUNDS = weakref.WeakKeyDictionary()
+
+def _redraw(ax):
+    """
+    Rescale reused axes to the new lines and redraw them. While the limits
+    and the axes box stay the same only the lines and legend are blitted
+    over a cached background instead of repainting ticks, spines and labels.
+    """
+    ax.relim()
+    ax.autoscale_view()
+    canvas = ax.figure.canvas
+    if not canvas.supports_blit:
+        canvas.draw_idle()
+        return None
+    artists = ax.lines + [ax.get_legend()]*bool(ax.get_legend())
+    view = (ax.bbox.bounds, ax.get_xlim(), ax.get_ylim())
+    cached = _BACKGROUNDS.get(ax)
+    if cached is None or cached[:3] != view:
+        #full draw once without the lines to keep a clean background
+        for artist in artists: artist.set_visible(False)
+        canvas.draw()
+        for artist in artists: artist.set_visible(True)
+        view = (ax.bbox.bounds, ax.get_xlim(), ax.get_ylim())
+        cached = _BACKGROUNDS[ax] = (*view, canvas.copy_from_bbox(ax.bbox))
+    canvas.restore_region(cached[3])
+    for artist in artists: ax.draw_artist(artist)
+    canvas.blit(ax.bbox)
+    return None
+
+
+def _label(dataset, attributes):
+    """'attribute:value' lines for the legend, joined once"""
+    get = dataset.attrs.get
+    return ''.join(f'{attribute}:{get(attribute)}\n' for attribute in attributes)
+
+
 def spectra(dataset, style='', save= '' , figsize=(6.3,6.3/2),
-        attributes=[], baseline='',  **kwargs):
+        attributes=[], baseline='', ax=None, data=None,
+        constrained_layout=True, **kwargs):
     """
     Plot a spectra from an HDF5 dataset.
 
@@ -92,8 +167,21 @@ def spectra(dataset, style='', save= '' , figsize=(6.3,6.3/2),
         attribute will be used as the intensity data, and the energy data will be taken from the first column
         of the dataset.
 
+    ax : matplotlib.axes.Axes, optional
+        Axes to draw on instead of creating a new figure. Their lines and legend are replaced, which is how
+        interactive_spectra updates one figure per slider change.
+
+    data : numpy.ndarray, optional
+        The energy and intensity columns of an h5py dataset (or its baseline) already in memory. The dataset
+        then only gives the title and label, as when interactive_spectra preloads small files.
+
+    constrained_layout : bool, optional
+        Lay out a new figure with Matplotlib's constrained layout, solved again on every draw. Default True,
+        pass False for figures redrawn often.
+
     **kwargs : additional keyword arguments
         Additional keyword arguments to be passed to the Matplotlib `ax.plot` function for customizing the plot.
+        A `label` given here is used instead of the one built from `attributes`.
 
     Returns:
     --------
@@ -104,35 +192,38 @@ def spectra(dataset, style='', save= '' , figsize=(6.3,6.3/2),
     # Plot a spectrum from an HDF5 dataset with custom styling and save the plot.
     spectra(hdf5_dataset, style='seaborn-darkgrid', save='spectrum.png', attributes=['sample_name'])
     """
-    label=''
+    #a label given by the caller (already built) replaces the attribute one
+    label = kwargs.pop('label', '')
     
     if is_dataset(dataset):
-        data = np.array(dataset)
         title = dataset.name
-        for attribute in attributes:
-            label += f'{attribute}:{dataset.attrs.get(attribute)}\n'
-        if baseline:
+        if attributes and not label: label = _label(dataset, attributes)
+        if data is not None: pass
+        elif baseline:
             data = dataset.attrs.get(baseline) 
+        else:
+            data = _read_xy(dataset)
     else:
-        data=np.array(dataset)
+        data=np.asarray(dataset)
 
     if style:
         try:plt.style.use(style)
         except NameError: plt.style.use('default')
 
-    fig, ax = plt.subplots(figsize=figsize, constrained_layout= True)
-    [l.remove() for l in ax.lines]#for interactive_spectra plot
-    ax.plot(data[:,0],data[:,1], label=label, **kwargs)
+    reuse = ax is not None
+    ax = _spectra_axes(ax, figsize, constrained_layout)
+    _draw_lines(ax, [(data[:,0], data[:,1], label)], **kwargs)
     ax.set_xlabel('Energy(eV)')
     ax.set_ylabel('Intensity(counts)')
     ax.minorticks_on()
     if label:ax.legend()
+    if reuse: _redraw(ax)
     if save: plt.savefig(save, dpi=dpi, transparent= True)
     return None
 
 
 def spectra_and_baseline(dataset,baseline='Baseline', style='', save= '' , figsize=(6.3,6.3/2),
-       attributes=[],  **kwargs):
+       attributes=[], ax=None, constrained_layout=True, **kwargs):
    """
    Plot a spectra from an HDF5 dataset.
 
@@ -158,6 +249,12 @@ def spectra_and_baseline(dataset,baseline='Baseline', style='', save= '' , figsi
        attribute will be used as the intensity data, and the energy data will be taken from the first column
        of the dataset.
 
+   ax : matplotlib.axes.Axes, optional
+       Axes to draw on instead of creating a new figure, see spectra.
+
+   constrained_layout : bool, optional
+       Lay out a new figure with constrained layout, see spectra.
+
    **kwargs : additional keyword arguments
        Additional keyword arguments to be passed to the Matplotlib `ax.plot` function for customizing the plot.
 
@@ -173,33 +270,69 @@ def spectra_and_baseline(dataset,baseline='Baseline', style='', save= '' , figsi
    label=''
    
    if is_dataset(dataset):
-       data = np.array(dataset)
+       data = _read_xy(dataset)
        title = dataset.name
-       for attribute in attributes:
-           label += f'{attribute}:{dataset.attrs.get(attribute)}\n'
+       label = _label(dataset, attributes)
        if baseline:
            baseline = dataset.attrs.get(f'{baseline}')
        else: return print('No baseline!!!') 
    else:
-       data=np.array(dataset)
+       data=np.asarray(dataset)
 
    if style:
        try:plt.style.use(style)
        except NameError: plt.style.use('default')
 
-   fig, ax = plt.subplots(figsize=figsize, constrained_layout= True)
-   [l.remove() for l in ax.lines]#for interactive_spectra plot
-   ax.plot(data[:,0],data[:,1], label='Original Spectrum\n'+label, **kwargs)
-   ax.plot(baseline[:,0],baseline[:,1], label='Baseline Substract', **kwargs)
+   reuse = ax is not None
+   ax = _spectra_axes(ax, figsize, constrained_layout)
+   _draw_lines(ax, [(data[:,0], data[:,1], 'Original Spectrum\n'+label),
+       (baseline[:,0], baseline[:,1], 'Baseline Substract')], **kwargs)
    ax.set_xlabel('Energy(eV)')
    ax.set_ylabel('Intensity(counts)')
    ax.minorticks_on()
    if label:ax.legend()
+   if reuse: _redraw(ax)
    if save: plt.savefig(save, dpi=dpi, transparent= True)
 
    return None
 
 
+#interactive_spectra keeps every spectrum in memory up to this size
+_PRELOAD_BYTES = 256*1024*1024
+#otherwise this many recently shown spectra stay in memory
+_CACHED_SPECTRA = 32
+#read size for files opened from a URL
+_REMOTE_BLOCK = 8*1024*1024
+#threads inflating compressed spectra in waterfall
+_WATERFALL_WORKERS = 4
+#chunks below this size make scattered reads pay one HDF5 lookup per few KiB
+_SMALL_CHUNK = 64*1024
+#one background reader shared by every interactive_spectra instead of a
+#pool per call that nothing shuts down when the file is closed
+_PREFETCH = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+class _RemoteFile(h5py.File):
+    """h5py File read from an fsspec file object, closing both together"""
+    def __init__(self, remote, **kwargs):
+        super().__init__(remote, **kwargs)
+        self._remote = remote
+
+    def close(self):
+        super().close()
+        self._remote.close()
+
+
+def _warn_small_chunks(dataset):
+    """Warn when a dataset is split in chunks smaller than _SMALL_CHUNK"""
+    if not is_dataset(dataset) or dataset.chunks is None: return None
+    nbytes = int(np.prod(dataset.chunks))*dataset.dtype.itemsize
+    if nbytes < _SMALL_CHUNK < dataset.nbytes:
+        warnings.warn(f'{dataset.name} is stored in {nbytes} byte chunks '
+                f'{dataset.chunks}, rewrite it with chunks of 64 KiB or more '
+                'for faster reads', RuntimeWarning)
+    return None
+
+
 def interactive_spectra(file_name_or_object, keys, mode='r',
                 style='', attributes=[], baseline='', plot=spectra, **kwargs):
     """
@@ -211,14 +344,18 @@ def interactive_spectra(file_name_or_object, keys, mode='r',
     Parameters:
     -----------
     file_name_or_object : str or h5py.File or h5py.Group
-        The name of the HDF5 file or an open h5py File/Group object to read data from. 
+        The name of the HDF5 file or an open h5py File/Group object to read data from. URLs such as
+        's3://bucket/data.h5' are opened read-only through fsspec (required for them) in 8 MiB blocks, and
+        closing the returned file also closes the remote one.
 
     keys : tuple
         A tuple containing keys corresponding to datasets within the HDF5 file. These keys are used
         to select different spectra for interactive plotting.
 
     mode : str, optional
-        The file access mode for reading the HDF5 file. Default is 'r' (read-only).
+        The file access mode for reading the HDF5 file. Default is 'r' (read-only). Files opened by name in
+        mode 'r' are opened without HDF5 file locking, so no other process may write them meanwhile. URLs
+        only accept 'r', other modes raise ValueError.
 
     style : str, optional
         The Matplotlib style to apply to the interactive plot. If not specified, the default style is used.
@@ -258,21 +395,85 @@ def interactive_spectra(file_name_or_object, keys, mode='r',
     sample.close()
     """
 
-    if isinstance(file_name_or_object, str):
-        sample = h5py.File(file_name_or_object, mode=mode)
+    if isinstance(file_name_or_object, str) and '://' in file_name_or_object:
+        #remote files (s3://, https://...) are read in large blocks through
+        #fsspec instead of the many small reads HDF5 issues
+        if mode != 'r':
+            raise ValueError(f"URLs can only be opened with mode 'r', not {mode!r}")
+        import fsspec
+        remote = fsspec.open(file_name_or_object, mode='rb',
+                block_size=_REMOTE_BLOCK).open()
+        sample = _RemoteFile(remote, mode='r', **_FILE_DEFAULTS)
+    elif isinstance(file_name_or_object, str):
+        #same chunk cache as the h5utils readers, read-only files skip the
+        #HDF5 file lock (no writer may change the file while it is open)
+        locking = {'locking': False} if mode == 'r' else {}
+        sample = h5py.File(file_name_or_object, mode=mode, **_FILE_DEFAULTS,
+                **locking)
     elif isinstance(file_name_or_object, h5py.File):
         sample = file_name_or_object
 
+    #resolve the datasets once, the slider only indexes them
+    datasets = [sample.get(key) for key in keys]
+    for dataset in datasets: _warn_small_chunks(dataset)
+    #small files are read once, a slider change then only indexes memory.
+    #Larger ones keep the last _CACHED_SPECTRA read. With a baseline its
+    #attribute (same size as the spectrum) is kept instead
+    xy = labels = prefetch = None
+    if plot is spectra and all(map(is_dataset, datasets)):
+        def load(key):
+            if baseline: return datasets[key].attrs.get(baseline)
+            return _read_xy(datasets[key])
+        def label(key):
+            return _label(datasets[key], attributes)
+        if (sum(d.shape[0]*2*d.dtype.itemsize for d in datasets)
+                <= _PRELOAD_BYTES):
+            xy = list(map(load, range(len(datasets)))).__getitem__
+            labels = list(map(label, range(len(datasets)))).__getitem__
+        else:
+            xy = functools.lru_cache(maxsize=_CACHED_SPECTRA)(load)
+            labels = functools.lru_cache(maxsize=_CACHED_SPECTRA)(label)
+            #neighbours are read in the background while the plot renders
+            prefetch = _PREFETCH
+
+    #the built-in plotters get the style once here, not on every slider
+    #change; custom ones still receive it as before
+    builtin = plot in (spectra, spectra_and_baseline)
+    if style and builtin:
+        try:plt.style.use(style)
+        except NameError: plt.style.use('default')
+
+    #interactive backends (ipympl) update one figure per slider change,
+    #inline figures are closed after each change so they are rebuilt
+    ax = None
+    if builtin and 'inline' not in mpl.get_backend():
+        #laid out once below instead of solving constrained layout per draw
+        fig, ax = plt.subplots(figsize=(6.3,6.3/2))
+
+    #ipywidgets is only needed here, importing it on demand keeps the
+    #module import light for scripts
+    import ipywidgets as widgets
+
     #with sample.access_h5() as h5_obj:
     @widgets.interact(key=(0, len(keys) - 1 , 1))
     def plot_interact(key=0):
         """Remove old lines from plot and plot net one"""
-        dataset = sample.get(keys[key])
+        dataset = datasets[key]
         print(dataset.name)
-        plot(dataset, style=style, attributes=attributes, baseline=baseline)
+        if xy is not None:
+            plot(dataset, ax=ax, data=xy(key), label=labels(key))
+            if prefetch is not None:
+                for near in (key + 1, key - 1):
+                    if 0 <= near < len(datasets): prefetch.submit(xy, near)
+        elif not builtin:
+            plot(dataset, style=style, attributes=attributes, baseline=baseline)
+        elif ax is None:
+            plot(dataset, attributes=attributes, baseline=baseline)
+        else:
+            plot(dataset, attributes=attributes, baseline=baseline, ax=ax)
         return None
         
-        
+    if ax is not None: fig.tight_layout()
     return sample
 
 
@@ -323,24 +524,26 @@ def spectra_map(dataset, cmap='binary', style='', save= '' , attributes=[], inte
     Example Usage:
     spectra_map(dataset, cmap='viridis', style='seaborn', save='spectra.png', attributes=['Sample', 'Temperature'])
     """
-    label=''
     if is_dataset(dataset):
-        X, Y, Z = np.array(dataset)
-        if func: Z=func(Z)
-        for attribute in attributes:
-            label += f'{attribute}:{dataset.attrs.get(attribute)}\n'
-        if interval:
-            Y[Y<interval[0]]= np.nan
-            Y[Y>interval[1]]= np.nan
-            delete = []
-            for m in range(Y.shape[0]):
-                if np.isnan(Y[m,0]):
-                    delete.append(m)
-            X = np.delete(X, delete, axis=0)
-            Y = np.delete(Y, delete, axis=0)
-            Z = np.delete(Z, delete, axis=0)
+        if interval and not func:
+            #only the energy rows inside the interval are read, as one slab
+            #when they are consecutive
+            energy = dataset[1, :, 0]
+            keep = (energy >= interval[0]) & (energy <= interval[1])
+            rows = np.flatnonzero(keep)
+            if rows.size and rows[-1] - rows[0] + 1 == rows.size:
+                X, Y, Z = dataset[:, rows[0]:rows[-1] + 1]
+            else:
+                X, Y, Z = dataset[()][:, keep]
+        else:
+            X, Y, Z = dataset[()]
+            if func: Z=func(Z)
+            if interval:
+                #keep the energy rows inside the interval
+                keep = (Y[:,0] >= interval[0]) & (Y[:,0] <= interval[1])
+                X, Y, Z = X[keep], Y[keep], Z[keep]
     else:
-        X, Y, Z=np.array(dataset)
+        X, Y, Z=np.asarray(dataset)
 
     if style:
         try:plt.style.use(style)
@@ -380,35 +583,44 @@ def waterfall(file_name_or_object, keys, offsetplot, vlines = (),
     ax.minorticks_on()
 
     initv = 0.0
-    maxv = []
-    minv = []
-    with h5py.File(file_name_or_object, mode='r') as file:
-        for count, key in enumerate(keys):
-            dataset = file.get(key)
-            if func: data = func(dataset)
-            else: data= np.array(dataset)
-
+    #opened through h5utils: 64 MiB chunk cache, open files are used as is
+    with _access_h5(file_name_or_object, mode='r') as file:
+        #compressed datasets whose chunks overflow the file cache get their own
+        nbytes = file.file.id.get_access_plist().get_cache()[2]
+        datasets = [_chunk_cached(file, key, nbytes) for key in keys]
+        if func: spectra_data = [func(dataset) for dataset in datasets]
+        else:
+            #h5py serialises HDF5 calls, but gzip chunks are inflated by
+            #threads in parallel (zlib releases the GIL)
+            with concurrent.futures.ThreadPoolExecutor(_WATERFALL_WORKERS) as executor:
+                spectra_data = [_read_deflated(dataset, executor)[:, :2]
+                        if _only_deflate(dataset) else _read_xy(dataset)
+                        for dataset in datasets]
+        heights = offsetplot*np.arange(len(datasets))
+        for dataset, data, height in zip(datasets, spectra_data, heights):
             #label
             if label_position: pass
             else: label_position = data[0,0]
             if label_offset: pass
             else: label_offset = np.mean(data[:,1])
             label_offset = np.min(data[:,1]) + label_offset 
-            label = ''  
-            for attribute in attributes_units:
-                       label += f'{dataset.attrs.get(attribute[0])}{attribute[1]}\n'
-
-            #plots
-            height = offsetplot*count
-            maxv.append(np.amax(data[:,1])+height)
-            minv.append(np.amin(data[:,1]))
-            ax.plot(data[:,0], data[:,1]+ height,ls='-', color = 'k')
+            label = ''.join(f'{dataset.attrs.get(attribute[0])}{attribute[1]}\n'
+                    for attribute in attributes_units)
             ax.text(label_position, label_offset+height, label, color="k")
 
             #initv =  xdata[find_near(ydata, maxv[0])]
 
-
-    ax.vlines(vlines, minv[0], maxv[-1], ls = '--', color = 'k')
+        #plots, every offset spectrum goes in one LineCollection
+        segments = [np.column_stack((data[:,0], data[:,1]+ height))
+                for data, height in zip(spectra_data, heights)]
+        ax.add_collection(LineCollection(segments, linestyles='-', colors='k',
+                capstyle=mpl.rcParams['lines.solid_capstyle'],
+                joinstyle=mpl.rcParams['lines.solid_joinstyle']))
+        ax.autoscale_view()
+        minv = np.amin(spectra_data[0][:,1])
+        maxv = np.amax(spectra_data[-1][:,1])+heights[-1]
+
+    ax.vlines(vlines, minv, maxv, ls = '--', color = 'k')
     ax.set_yticks([])
     if x_limit: ax.set_xlim([x_limit[0],x_limit[1]])
     if y_limit: ax.set_ylim([y_limit[0],y_limit[1]])
@@ -491,19 +703,13 @@ def ImageZooms(image, Px, Py, dx, dy, labels,
 
     if isinstance(image, type('')):
         image = mpimg.imread(image)
-    elif isinstance(image, np.ndarray):
-        image = image
-    else:
+    elif not isinstance(image, np.ndarray):
         return None
 
     fig = plt.figure(figsize=figsize)
     
-    shape = np.shape(image) 
-    if len(dx)==len(Px) and len(dy)==len(Py) and len(Px)==len(Py):
-        n = len(Px)
-    else:
-        lens = np.array([len(dx), len(dy), len(Px), len(Py)])
-        n = int(np.min(lens))
+    shape = image.shape
+    n = min(len(dx), len(dy), len(Px), len(Py))
 
     gs = GridSpec(n, n + 1)
 
@@ -527,12 +733,14 @@ def ImageZooms(image, Px, Py, dx, dy, labels,
         ya, yb = [0, shape[0]-1]
 
     
-    ax = plt.subplot(gs[:n, :n], xlim=[xa, xb],
+    ax = fig.add_subplot(gs[:n, :n], xlim=[xa, xb],
             xticks=[], ylim=[ya, yb], yticks=[], aspect=1)
-    ax.imshow(image, cmap=cmap)
+    #zooms share the colour scale of the whole image
+    norm = ax.imshow(image, cmap=cmap).norm
 
+    rects = []
     for i, (x, y) in enumerate(zip(Px, Py)):
-        sax = plt.subplot(
+        sax = fig.add_subplot(
             gs[i, n],
             xlim=[x - dx[i], x + dx[i]],
             xticks=[],
@@ -540,7 +748,13 @@ def ImageZooms(image, Px, Py, dx, dy, labels,
             yticks=[],
             aspect=1,
         )
-        sax.imshow(image , cmap=cmap)
+        #draw only the pixels in view, extent keeps them in image coordinates
+        x0 = max(int(np.floor(x - dx[i])), 0)
+        x1 = min(int(np.ceil(x + dx[i])) + 1, shape[1])
+        y0 = max(int(np.floor(y - dy[i])), 0)
+        y1 = min(int(np.ceil(y + dy[i])) + 1, shape[0])
+        sax.imshow(image[y0:y1, x0:x1], cmap=cmap, norm=norm,
+                extent=(x0 - 0.5, x1 - 0.5, y1 - 0.5, y0 - 0.5))
     
         sax.text(
             1.1,
@@ -562,7 +776,7 @@ def ImageZooms(image, Px, Py, dx, dy, labels,
             linestyle="--",
             linewidth=0.75,
         )
-        ax.add_patch(rect)
+        rects.append(rect)
     
         con = ConnectionPatch(
             xyA=(x, y),
@@ -575,8 +789,12 @@ def ImageZooms(image, Px, Py, dx, dy, labels,
             arrowstyle="->",
         )
         fig.add_artist(con)
-    
-    
+
+    #one collection for every zoom frame instead of one patch each, the
+    #frames keep the data transform so the arrows still start at their edge
+    frames = PatchCollection(rects, match_original=True)
+    for rect in rects: rect.set_transform(ax.transData)
+    ax.add_collection(frames, autolim=False)
     plt.tight_layout()
     if save: plt.savefig(save)
     return None